@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Memory used per in-flight message, keeping the parsed message, its
+obj_info and the serialized document (as before) or an ObjectEvent
+
+Usage: python benchmarks/event_memory.py [number of messages]
+"""
+
+import json
+import os
+import resource
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'swift_search_worker'))
+
+from utils import get_event, get_obj_info  # noqa
+
+
+def message(i):
+    return json.dumps({
+        'http_method': 'PUT',
+        'uri': '/v1/AUTH_{:032x}/container/path/to/object-{}'.format(
+            i % 100, i),
+        'headers': {
+            'Content-Type': 'application/octet-stream',
+            'Etag': '{:032x}'.format(i),
+            'X-Object-Meta-Owner': 'someone',
+            'X-Object-Meta-Tags': 'tag1,tag2,tag3'
+        },
+        'timestamp': '2017-02-02T16:53:33.355817'
+    })
+
+
+def as_dicts(body):
+    data = json.loads(body)
+    obj_info = get_obj_info(data)
+    return data, obj_info, json.dumps(obj_info)
+
+
+def as_event(body):
+    return get_event(json.loads(body))
+
+
+def measure(build, bodies):
+    tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    in_flight = [build(body) for body in bodies]
+
+    _, peak = tracemalloc.get_traced_memory()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.stop()
+
+    del in_flight
+
+    # ru_maxrss is in kilobytes on Linux
+    return peak / len(bodies), (rss_after - rss_before) * 1024 / len(bodies)
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bodies = [message(i) for i in range(total)]
+
+    # The event run goes first, so the peak RSS growth is not hidden by
+    # memory already taken by the dicts run
+    for name, build in (('event', as_event), ('dicts', as_dicts)):
+        heap, rss = measure(build, bodies)
+        print('{:<6} heap peak {:>8.0f} B/msg, peak RSS growth {:>8.0f} '
+              'B/msg'.format(name, heap, rss))
@@ -1,5 +1,17 @@
 import os
 
+
+def tenants_config(name):
+    # "project_id:value,project_id:value" to {project_id: value}
+    values = {}
+    for item in os.getenv(name, '').split(','):
+        if item:
+            project_id, value = item.split(':')
+            values[project_id] = float(value)
+
+    return values
+
+
 QUEUE_URL = os.getenv('QUEUE_URL')
 QUEUE_PORT = os.getenv('QUEUE_PORT')
 QUEUE_USERNAME = os.getenv('QUEUE_USERNAME')
@@ -7,6 +19,18 @@ QUEUE_PASSWORD = os.getenv('QUEUE_PASSWORD')
 QUEUE_NAME = os.getenv('QUEUE_NAME')
 QUEUE_VHOST = os.getenv('QUEUE_VHOST')
 
+# Max unacked messages RabbitMQ delivers to the worker
+QUEUE_PREFETCH = int(os.getenv('QUEUE_PREFETCH', 500))
+
+# Events are indexed when the buffer reaches QUEUE_PREFETCH events or
+# BUFFER_MAX_BYTES, or every BUFFER_FLUSH_INTERVAL seconds
+# QUEUE_PREFETCH is the main limit: it is what stops RabbitMQ from sending
+# more messages. An event takes about 600 bytes (see `make bench`), so the
+# default BUFFER_MAX_BYTES only flushes earlier when events carry more
+# than 1 KB of metadata on average
+BUFFER_MAX_BYTES = int(os.getenv('BUFFER_MAX_BYTES', 512 * 1024))
+BUFFER_FLUSH_INTERVAL = int(os.getenv('BUFFER_FLUSH_INTERVAL', 1))
+
 
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
@@ -14,3 +38,59 @@ TOKEN_ENDPOINT = os.getenv('ENDPOINT')
 
 # Elastic Search URL
 ES_URL = os.getenv('SEARCHENGINE_URL')
+
+# Extra Elastic Search URLs (comma separated) that also receive every
+# document, e.g. the new cluster during a migration
+ES_REPLICA_URLS = [url for url in
+                   os.getenv('SEARCHENGINE_REPLICA_URLS', '').split(',') if url]
+
+# When a message is acked if there are replicas: all, primary or quorum
+ES_ACK_POLICY = os.getenv('SEARCHENGINE_ACK_POLICY', 'all')
+
+# Max documents (and bytes) each Elastic Search keeps to retry when it
+# fails but the message is acked anyway (ack policy primary or quorum).
+# Over it, the oldest document ids are logged to be backfilled. This memory
+# is apart from BUFFER_MAX_BYTES, since those messages are already acked.
+# The documents still pending on shutdown are logged too. On a crash they
+# are lost without a log
+ES_MAX_RETRIES = int(os.getenv('SEARCHENGINE_MAX_RETRIES', 10000))
+ES_MAX_RETRY_BYTES = int(os.getenv('SEARCHENGINE_MAX_RETRY_BYTES',
+                                   8 * 1024 * 1024))
+
+# Seconds to wait for each Elastic Search request
+ES_TIMEOUT = float(os.getenv('SEARCHENGINE_TIMEOUT', 10))
+
+# Interval (seconds) to log the indexing metrics of each Elastic Search
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 60))
+
+# SEARCHENGINE_URL (and replicas) may have a {project_id} placeholder, for
+# one index per project, or a {bucket} one, for a family of indexes where
+# projects are hashed into SEARCHENGINE_INDEX_BUCKETS indexes.
+# {project_id} needs a prefix on the index name, e.g. swift-{project_id}
+ES_INDEX_BUCKETS = int(os.getenv('SEARCHENGINE_INDEX_BUCKETS', 1))
+
+# Use the project_id as the ES routing value, so documents of a project
+# stay on the same shard
+#
+# Changing the index placeholders, SEARCHENGINE_INDEX_BUCKETS or the routing
+# needs new indexes (or a reindex): documents already indexed are not moved.
+# On an existing index with routing turned on, a PUT creates a second copy
+# of a document on another shard, and a DELETE looks at the routed shard,
+# gets a 404 (taken as success) and leaves the old document there
+ES_ROUTING = os.getenv('SEARCHENGINE_ROUTING', 'false').lower() == 'true'
+
+# Fair scheduling of events between projects
+# TENANT_WEIGHTS: events a project dispatches per round (default 1)
+# TENANT_RATE_CAPS: events per second of a project on each worker before
+# its events are held back (default TENANT_DEFAULT_RATE_CAP, 0 is no cap)
+#
+# Without caps, the events of each flush are only reordered by round-robin.
+# A project over its cap has its events held in the buffer (unacked) while
+# other projects have events to index, so the worker keeps reading ahead
+# on the queue and indexes the other projects' events first. With nobody
+# else waiting its events are indexed at full speed. The reach is
+# QUEUE_PREFETCH messages: projects further behind on the queue still
+# wait for the events ahead of them
+TENANT_WEIGHTS = tenants_config('TENANT_WEIGHTS')
+TENANT_RATE_CAPS = tenants_config('TENANT_RATE_CAPS')
+TENANT_DEFAULT_RATE_CAP = float(os.getenv('TENANT_DEFAULT_RATE_CAP', 0))
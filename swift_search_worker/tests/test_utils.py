@@ -1,11 +1,13 @@
 import collections
 import json
+import threading
 import unittest
 
 from mock import Mock, patch
 from swift_search_worker.utils import queue_connection, queue_channel,\
-    get_obj_info, ElasticSearchUtils
-from swift_search_worker.worker import callback
+    get_obj_info, get_event, get_index_url, ElasticSearchUtils, \
+    EventBuffer, FairScheduler, ObjectEvent
+from swift_search_worker.worker import callback, flush
 
 
 class UtilsTestCase(unittest.TestCase):
@@ -68,6 +70,16 @@ class UtilsTestCase(unittest.TestCase):
 
         self.assertEqual(computed, channel)
 
+    def test_queue_channel_with_prefetch(self):
+
+        connection = Mock()
+        channel = Mock()
+        connection.channel.return_value = channel
+
+        queue_channel(connection, 'queue_name', 10)
+
+        channel.basic_qos.assert_called_with(prefetch_count=10)
+
     def test_queue_channel_fails(self):
 
         connection = Mock()
@@ -115,6 +127,108 @@ class UtilsTestCase(unittest.TestCase):
         self.log.error.called_once()
         self.assertIsNone(computed)
 
+    def test_get_event(self):
+        data = {
+            'http_method': 'PUT',
+            'uri': '/v1/AUTH_acc/con/o/b/j',
+            'headers': {
+                'header1': 'value1'
+            },
+            'timestamp': 'my-time-stamp'
+        }
+
+        event = get_event(data, 'delivered')
+
+        self.assertEqual(event.method, 'PUT')
+        self.assertEqual(event.project_id, 'acc')
+        self.assertEqual(event.container, 'con')
+        self.assertEqual(event.obj, 'o/b/j')
+        self.assertEqual(event.timestamp, 'my-time-stamp')
+        self.assertEqual(event.headers, '{"header1": "value1"}')
+        self.assertEqual(event.delivery_tag, 'delivered')
+
+        # The document is the same built from get_obj_info
+        self.assertEqual(event.to_json(), json.dumps(get_obj_info(data)))
+
+    def test_get_event_delete(self):
+        data = {
+            'http_method': 'DELETE',
+            'uri': '/v1/AUTH_acc/con/o/b/j',
+            'timestamp': 'my-time-stamp'
+        }
+
+        event = get_event(data)
+
+        self.assertIsNone(event.headers)
+        self.assertEqual(event.timestamp, 'my-time-stamp')
+
+    def test_get_event_invalid_uri(self):
+        computed = get_event({'uri': '/healthcheck'})
+
+        self.assertIsNone(computed)
+
+    def test_event_buffer(self):
+        event = ObjectEvent('POST', '1234', 'con', 'o/b/j', '1997', '{}')
+        buff = EventBuffer(max_bytes=event.size * 3, max_events=10)
+
+        buff.add(event)
+        buff.add(event)
+        self.assertFalse(buff.full)
+
+        buff.add(event)
+        self.assertTrue(buff.full)
+
+        for _ in range(3):
+            buff.release(event)
+        self.assertEqual(len(buff), 0)
+        self.assertEqual(buff.size, 0)
+
+    def test_event_buffer_failed(self):
+        failed = ObjectEvent('POST', '1234', 'con', 'f', '1997', '{}')
+        buff = EventBuffer(max_bytes=failed.size * 10, max_events=10)
+
+        buff.add(failed)
+        buff.add_failed(failed)
+
+        # Still in flight until it is acked
+        self.assertEqual(len(buff), 1)
+        self.assertEqual(list(buff.drain_failed()), [failed])
+        self.assertEqual(list(buff.drain_failed()), [])
+        self.assertEqual(len(buff), 1)
+
+    def test_event_buffer_max_events(self):
+        event = ObjectEvent('POST', '1234', 'con', 'o/b/j', '1997', '{}')
+        buff = EventBuffer(max_bytes=event.size * 10, max_events=2)
+
+        buff.add(event)
+        self.assertFalse(buff.full)
+
+        buff.add(event)
+        self.assertTrue(buff.full)
+
+    def test_get_index_url(self):
+        computed = get_index_url('es_url/swift/object', 'ABC')
+
+        self.assertEqual(computed, 'es_url/swift/object')
+
+    def test_get_index_url_per_project(self):
+        computed = get_index_url('es_url/swift-{project_id}/object', 'ABC')
+
+        self.assertEqual(computed, 'es_url/swift-abc/object')
+
+    def test_get_index_url_invalid_chars(self):
+        computed = get_index_url('es_url/swift-{project_id}/object',
+                                 'A/b*c?d"e<f>g|h,i#j k:l+m\\n')
+
+        self.assertEqual(computed,
+                         'es_url/swift-a_b_c_d_e_f_g_h_i_j_k_l_m_n/object')
+
+    def test_get_index_url_hashed(self):
+        computed = get_index_url('es_url/swift-{bucket}/object', 'abc', 8)
+
+        # zlib.crc32(b'abc') % 8
+        self.assertEqual(computed, 'es_url/swift-2/object')
+
 
 class ElasticSearchUtilsTestCase(unittest.TestCase):
 
@@ -153,17 +267,39 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
     def test_get_es_obj_url(self):
         es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url')
 
-        obj_info = {
-            'project_id': '1234',
-            'container': 'con',
-            'object': 'o/b/j'
-        }
+        event = ObjectEvent('POST', '1234', 'con', 'o/b/j', '1997')
 
-        computed = es._get_es_obj_url(obj_info)
+        computed = es._get_es_obj_url(event)
         expected = 'es_url/1234%2Fcon%2Fo%2Fb%2Fj'
 
         self.assertEqual(computed, expected)
 
+    def test_get_es_obj_url_with_routing(self):
+        es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec',
+                                'es_url/swift-{project_id}', routing=True)
+
+        event = ObjectEvent('POST', '1234', 'con', 'o/b/j', '1997')
+
+        computed = es._get_es_obj_url(event)
+        expected = 'es_url/swift-1234/1234%2Fcon%2Fo%2Fb%2Fj?routing=1234'
+
+        self.assertEqual(computed, expected)
+
+    def test_project_id_index_without_prefix(self):
+
+        with self.assertRaises(ValueError):
+            ElasticSearchUtils('token_url', 'cli_id', 'cli_sec',
+                               'es_url/{project_id}/object')
+
+    def test_get_search_url(self):
+        es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec',
+                                'es_url/swift-{project_id}', routing=True)
+
+        computed = es.get_search_url('1234')
+        expected = 'es_url/swift-1234/_search?routing=1234'
+
+        self.assertEqual(computed, expected)
+
     def test_send_to_elastic_invalid_data(self):
 
         es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url')
@@ -218,7 +354,8 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
             data=json.dumps(obj_info),
             headers={
                 'Content-Type': 'application/json'
-            })
+            },
+            timeout=10)
 
         self.assertTrue(status)
 
@@ -250,7 +387,8 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
             data=json.dumps(obj_info),
             headers={
                 'Content-Type': 'application/json'
-            })
+            },
+            timeout=10)
 
         self.assertFalse(status)
         self.assertEquals(msg, "Object not created")
@@ -284,7 +422,8 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
             data=json.dumps(obj_info),
             headers={
                 'Content-Type': 'application/json'
-            })
+            },
+            timeout=10)
 
         self.assertFalse(status)
         self.assertEqual(msg, 'Unable to POST data to ES')
@@ -312,7 +451,7 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
         self.data['http_method'] = 'DELETE'
         _, status = es.send_to_elastic(self.data)
 
-        client.delete.assert_called_with('obj-url')
+        client.delete.assert_called_with('obj-url', timeout=10)
         self.assertTrue(status)
 
     @patch('swift_search_worker.utils.ElasticSearchUtils._get_es_obj_url')
@@ -340,7 +479,7 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
         self.data['http_method'] = 'DELETE'
         msg, status = es.send_to_elastic(self.data)
 
-        client.delete.assert_called_with('obj-url')
+        client.delete.assert_called_with('obj-url', timeout=10)
         self.assertFalse(status)
         self.assertEqual(msg, 'Unable to DELETE data on ES')
 
@@ -371,7 +510,7 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
         self.data['http_method'] = 'DELETE'
         _, status = es.send_to_elastic(self.data)
 
-        client.delete.assert_called_with('obj-url')
+        client.delete.assert_called_with('obj-url', timeout=10)
         self.assertTrue(status)
 
     @patch('swift_search_worker.utils.ElasticSearchUtils._get_es_obj_url')
@@ -404,7 +543,8 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
             data=json.dumps(obj_info),
             headers={
                 'Content-Type': 'application/json'
-            })
+            },
+            timeout=10)
 
         self.assertTrue(status)
 
@@ -438,11 +578,358 @@ class ElasticSearchUtilsTestCase(unittest.TestCase):
             data=json.dumps(obj_info),
             headers={
                 'Content-Type': 'application/json'
-            })
+            },
+            timeout=10)
 
         self.assertFalse(status)
         self.assertEqual(msg, 'Unable to PUT data to ES')
 
+    def test_invalid_ack_policy(self):
+
+        with self.assertRaises(ValueError):
+            ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url',
+                               ack_policy='some')
+
+    def _replicated_es(self, status_codes, ack_policy):
+        clients = []
+        for status_code in status_codes:
+            client = Mock()
+            client.post.return_value = self.response(status_code=status_code)
+            clients.append(client)
+        self.client.side_effect = clients
+
+        es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url',
+                                ['es_url2', 'es_url3'], ack_policy)
+
+        return es, clients
+
+    def _wait_targets(self, es):
+        # Writes to a target run in order on its own thread
+        for target in es.targets:
+            target.executor.submit(lambda: None).result()
+
+    def test_send_to_elastic_replicas(self):
+
+        es, clients = self._replicated_es([201, 201, 201], 'all')
+        _, status = es.send_to_elastic(self.data)
+
+        body = clients[0].post.call_args[1]['data']
+        for client, url in zip(clients, ['es_url', 'es_url2', 'es_url3']):
+            client.post.assert_called_with(
+                url + '/acc%2Fcon%2Fo%2Fb%2Fj',
+                data=body,
+                headers={
+                    'Content-Type': 'application/json'
+                },
+                timeout=10)
+
+        self.assertTrue(status)
+        self.assertEqual(es.metrics()['es_url2']['sent'], 1)
+
+    def test_send_to_elastic_replicas_ack_all(self):
+
+        es, _ = self._replicated_es([201, 201, 500], 'all')
+        msg, status = es.send_to_elastic(self.data)
+
+        self.assertFalse(status)
+        self.assertEqual(msg, 'Object not created')
+
+        self._wait_targets(es)
+        self.assertEqual(es.metrics()['es_url3']['errors'], 1)
+
+    def test_send_to_elastic_replicas_ack_primary(self):
+
+        es, _ = self._replicated_es([201, 500, 500], 'primary')
+        _, status = es.send_to_elastic(self.data)
+        self.assertTrue(status)
+
+        es, _ = self._replicated_es([500, 201, 201], 'primary')
+        _, status = es.send_to_elastic(self.data)
+        self.assertFalse(status)
+
+    def test_send_to_elastic_replicas_ack_quorum(self):
+
+        es, _ = self._replicated_es([500, 201, 201], 'quorum')
+        _, status = es.send_to_elastic(self.data)
+        self.assertTrue(status)
+
+        es, _ = self._replicated_es([201, 500, 500], 'quorum')
+        _, status = es.send_to_elastic(self.data)
+        self.assertFalse(status)
+
+    def test_send_to_elastic_replica_retried(self):
+
+        es, clients = self._replicated_es([201, 500, 500], 'primary')
+        _, status = es.send_to_elastic(self.data)
+        self.assertTrue(status)
+
+        self._wait_targets(es)
+        replica = es.targets[1]
+        self.assertEqual(list(replica.retries), ['acc/con/o/b/j'])
+
+        # The replica is back
+        clients[1].post.reset_mock()
+        clients[1].post.return_value = self.response(status_code=201)
+        for future in es.retry_failed():
+            future.result()
+
+        clients[1].post.assert_called_once_with(
+            'es_url2/acc%2Fcon%2Fo%2Fb%2Fj',
+            data=clients[0].post.call_args[1]['data'],
+            headers={
+                'Content-Type': 'application/json'
+            },
+            timeout=10)
+        self.assertEqual(len(replica.retries), 0)
+
+        # The other one is still failing
+        self.assertEqual(len(es.targets[2].retries), 1)
+
+    def test_send_to_elastic_replica_not_retried_when_not_acked(self):
+
+        es, _ = self._replicated_es([201, 201, 500], 'all')
+        _, status = es.send_to_elastic(self.data)
+
+        self.assertFalse(status)
+        self._wait_targets(es)
+        self.assertEqual(len(es.targets[2].retries), 0)
+
+    def test_send_to_elastic_does_not_wait_slow_replica(self):
+
+        es, clients = self._replicated_es([201, 201, 201], 'quorum')
+
+        # A hung replica, failing only after the message is acked
+        release = threading.Event()
+
+        def hung(*args, **kwargs):
+            release.wait(5)
+            raise Exception('Timeout')
+
+        clients[2].post.side_effect = hung
+
+        _, status = es.send_to_elastic(self.data)
+        self.assertTrue(status)
+
+        release.set()
+        self._wait_targets(es)
+        self.assertEqual(list(es.targets[2].retries), ['acc/con/o/b/j'])
+        self.assertEqual(len(es.targets[1].retries), 0)
+
+    def test_send_to_elastic_too_many_pending_writes(self):
+
+        es, clients = self._replicated_es([201, 201, 201], 'primary')
+        es.targets[2].pending = es.targets[2].MAX_PENDING
+
+        _, status = es.send_to_elastic(self.data)
+
+        self.assertTrue(status)
+        clients[2].post.assert_not_called()
+        self.assertEqual(list(es.targets[2].retries), ['acc/con/o/b/j'])
+
+    def test_replica_retries_bounded(self):
+
+        self.client.side_effect = [Mock(), Mock()]
+        es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url',
+                                ['es_url2'], 'primary', max_retries=1)
+        replica = es.targets[1]
+
+        replica.add_retry(ObjectEvent('PUT', 'acc', 'con', 'a', '1997', '{}'))
+        replica.add_retry(ObjectEvent('PUT', 'acc', 'con', 'b', '1997', '{}'))
+
+        self.assertEqual(list(replica.retries), ['acc/con/b'])
+        self.log.error.assert_called_with(
+            'es_url2: retry buffer full, document acc/con/a must be '
+            'backfilled')
+
+    def test_replica_retries_bounded_by_bytes(self):
+
+        event = ObjectEvent('PUT', 'acc', 'con', 'a', '1997', '{}')
+        self.client.side_effect = [Mock(), Mock()]
+        es = ElasticSearchUtils('token_url', 'cli_id', 'cli_sec', 'es_url',
+                                ['es_url2'], 'primary',
+                                max_retry_bytes=event.size * 2)
+        replica = es.targets[1]
+
+        for obj in ['a', 'b', 'c']:
+            replica.add_retry(ObjectEvent('PUT', 'acc', 'con', obj, '1997',
+                                          '{}'))
+
+        self.assertEqual(list(replica.retries), ['acc/con/b', 'acc/con/c'])
+        self.assertEqual(replica.retries_size, event.size * 2)
+
+    def test_close_logs_pending_retries(self):
+
+        es, clients = self._replicated_es([201, 500, 201], 'primary')
+        es.send_to_elastic(self.data)
+
+        es.close()
+
+        self.assertEqual(clients[1].post.call_count, 2)
+        self.log.error.assert_called_with(
+            'es_url2: document acc/con/o/b/j must be backfilled')
+
+    def test_close_retries_pending(self):
+
+        es, clients = self._replicated_es([201, 500, 201], 'primary')
+        es.send_to_elastic(self.data)
+        self._wait_targets(es)
+
+        # The replica is back
+        clients[1].post.return_value = self.response(status_code=201)
+        self.log.error.reset_mock()
+        es.close()
+
+        self.assertEqual(len(es.targets[1].retries), 0)
+        self.log.error.assert_not_called()
+
+
+class FairSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Token buckets do not refill unless the time is changed
+        self.time = patch('swift_search_worker.utils.time', Mock()).start()
+        self.time.time.return_value = 0
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _scheduler(self, project_ids, **kwargs):
+        scheduler = FairScheduler(**kwargs)
+        self._add(scheduler, *project_ids)
+
+        return scheduler
+
+    def _add(self, scheduler, *project_ids):
+        for project_id in project_ids:
+            scheduler.add(ObjectEvent('POST', project_id, 'con', 'obj',
+                                      '1997', '{}'))
+
+    def _projects(self, events):
+        return [event.project_id for event in events]
+
+    def test_schedule_round_robin(self):
+        scheduler = self._scheduler(['big', 'big', 'big', 'small', 'other'])
+
+        events = scheduler.schedule()
+
+        self.assertEqual(self._projects(events),
+                         ['big', 'small', 'other', 'big', 'big'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_schedule_weights(self):
+        scheduler = self._scheduler(['big', 'big', 'small', 'small', 'small'],
+                                    weights={'small': 2, 'big': 0.5})
+
+        events = scheduler.schedule()
+
+        self.assertEqual(self._projects(events),
+                         ['small', 'small', 'big', 'small', 'big'])
+
+    def test_invalid_weight(self):
+
+        with self.assertRaises(ValueError):
+            FairScheduler(weights={'big': 0})
+
+    def test_schedule_holds_over_rate_cap(self):
+        scheduler = self._scheduler(['big', 'big', 'big', 'big', 'small'],
+                                    rate_caps={'big': 2})
+
+        # Only what is over the cap waits, while others have events
+        events = scheduler.schedule(limit=0)
+        self.assertEqual(self._projects(events), ['big', 'small', 'big'])
+        self.assertEqual(len(scheduler), 2)
+
+        # Held across flushes: events received later go first
+        self._add(scheduler, 'small', 'other')
+        events = scheduler.schedule(limit=0)
+        self.assertEqual(self._projects(events), ['small', 'other'])
+        self.assertEqual(len(scheduler), 2)
+
+        # The bucket refilled
+        self.time.time.return_value = 1
+        events = scheduler.schedule(limit=0)
+        self.assertEqual(self._projects(events), ['big', 'big'])
+
+    def test_schedule_work_conserving(self):
+        scheduler = self._scheduler(['big'] * 10, rate_caps={'big': 2})
+
+        # Nobody else is waiting, the events over the cap go up to the limit
+        events = scheduler.schedule(limit=1)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(len(scheduler), 7)
+
+        events = scheduler.schedule()
+        self.assertEqual(len(events), 7)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_schedule_work_conserving_rotates(self):
+        scheduler = self._scheduler(['big', 'big', 'huge', 'huge'],
+                                    default_rate_cap=1)
+        scheduler.schedule(limit=0)
+
+        events = scheduler.schedule(limit=1) + scheduler.schedule(limit=1)
+
+        self.assertEqual(sorted(self._projects(events)), ['big', 'huge'])
+
+    def test_schedule_default_rate_cap(self):
+        scheduler = self._scheduler(['big', 'big', 'small', 'small'],
+                                    rate_caps={'big': 0},
+                                    default_rate_cap=1)
+
+        events = scheduler.schedule(limit=0)
+
+        self.assertEqual(self._projects(events), ['big', 'small', 'big'])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_schedule_fractional_rate_cap(self):
+        scheduler = self._scheduler(['big', 'big'], rate_caps={'big': 0.5})
+
+        events = scheduler.schedule(limit=0)
+        self.assertEqual(self._projects(events), ['big'])
+
+        self.time.time.return_value = 1
+        self.assertEqual(scheduler.schedule(limit=0), [])
+
+        # One event every two seconds
+        self.time.time.return_value = 2
+        events = scheduler.schedule(limit=0)
+        self.assertEqual(self._projects(events), ['big'])
+
+    def test_invalid_rate_cap(self):
+
+        with self.assertRaises(ValueError):
+            FairScheduler(rate_caps={'big': -1})
+
+        with self.assertRaises(ValueError):
+            FairScheduler(default_rate_cap=-1)
+
+    def test_metrics(self):
+        scheduler = self._scheduler(['big', 'big', 'small', 'other'],
+                                    rate_caps={'big': 1})
+
+        events = scheduler.schedule(limit=0)
+        events[1].timestamp = '2017-02-02T16:53:33.355817'
+        for event in events:
+            scheduler.record(event, event.project_id != 'other')
+
+        metrics = scheduler.metrics()
+
+        self.assertEqual(metrics['big']['sent'], 1)
+        self.assertEqual(metrics['big']['held'], 1)
+        self.assertEqual(metrics['small']['sent'], 1)
+        self.assertEqual(metrics['other']['sent'], 0)
+        self.assertEqual(metrics['other']['failed'], 1)
+
+        # Waits since the event timestamp, not since it was consumed
+        self.assertGreater(metrics['small']['wait'], 3600)
+        # Invalid timestamps are left out
+        self.assertEqual(metrics['big']['wait'], 0)
+
+        # Metrics are since the last call, but the held events remain
+        self.assertEqual(scheduler.metrics(),
+                         {'big': {'sent': 0, 'failed': 0, 'held': 1,
+                                  'wait': 0}})
+
 
 class WorkerTestCase(unittest.TestCase):
 
@@ -463,29 +950,143 @@ class WorkerTestCase(unittest.TestCase):
         self.method = collections.namedtuple('Method', 'delivery_tag')
         self.channel = Mock()
 
+        self.elastic_utils = patch('swift_search_worker.worker.elastic_utils',
+                                   Mock()).start()
+
+        # Flushes on every message, unless max_events is changed
+        self.event_buffer = patch('swift_search_worker.worker.event_buffer',
+                                  EventBuffer(1024 * 1024, 1)).start()
+
+        self.scheduler = patch('swift_search_worker.worker.scheduler',
+                               FairScheduler()).start()
+
     def tearDown(self):
         patch.stopall()
 
-    @patch('swift_search_worker.worker.elastic_utils')
-    def test_callback_called_with_invalid_data(self, mock_elastic_utils):
-        mock_elastic_utils.send_to_elastic.side_effect = ValueError
+    def test_callback_called_with_invalid_data(self):
+        method = self.method(delivery_tag='delivered')
+        callback(self.channel, method, None, 'invalid-json')
+
+        self.channel.basic_reject.assert_called_with(delivery_tag='delivered',
+                                                     requeue=False)
+        self.elastic_utils.send_event.assert_not_called()
+
+    def test_callback_called_with_invalid_uri(self):
+        method = self.method(delivery_tag='delivered')
+        callback(self.channel, method, None, json.dumps({'uri': '/health'}))
+
+        self.channel.basic_reject.assert_called_with(delivery_tag='delivered',
+                                                     requeue=False)
+
+    def test_message_buffered(self):
+        self.event_buffer.max_events = 2
         method = self.method(delivery_tag='delivered')
         callback(self.channel, method, None, self.data)
-        self.log.error.called_with('Invalid message')
 
-    @patch('swift_search_worker.worker.elastic_utils')
-    def test_message_acknowledged(self, mock_elastic_utils):
-        mock_elastic_utils.send_to_elastic.return_value = "", True
+        self.elastic_utils.send_event.assert_not_called()
+        self.assertEqual(len(self.event_buffer), 1)
+
+    def test_message_acknowledged(self):
+        self.elastic_utils.send_event.return_value = "", True
         method = self.method(delivery_tag='delivered')
         callback(self.channel, method, None, self.data)
         self.channel.basic_ack.assert_called_with(delivery_tag='delivered')
 
-    @patch('swift_search_worker.worker.elastic_utils')
-    def test_message_failed(self, mock_elastic_utils):
-        mock_elastic_utils.send_to_elastic.return_value = "generic error message", False
+    def test_message_failed(self):
+        self.elastic_utils.send_event.return_value = "generic error message", False
+        method = self.method(delivery_tag='delivered')
+        callback(self.channel, method, None, self.data)
+        self.channel.basic_ack.assert_not_called()
+        self.channel.basic_nack.assert_not_called()
+        self.assertEqual(len(self.event_buffer.failed), 1)
+
+    def test_failed_message_retried_on_timer(self):
+        self.elastic_utils.send_event.return_value = "generic error message", False
+        callback(self.channel, self.method(delivery_tag='first'), None,
+                 self.data)
+
+        # A new message flushes the buffer, but the failed one is not
+        # sent again on the same tick
+        callback(self.channel, self.method(delivery_tag='second'), None,
+                 self.data)
+        self.assertEqual(self.elastic_utils.send_event.call_count, 2)
+        self.assertEqual(len(self.event_buffer.failed), 2)
+
+        # ES is back by the flush_timeout
+        self.elastic_utils.send_event.return_value = "", True
+        flush(self.channel, retry=True)
+
+        self.assertEqual(self.elastic_utils.send_event.call_count, 4)
+        self.channel.basic_ack.assert_any_call(delivery_tag='first')
+        self.channel.basic_ack.assert_any_call(delivery_tag='second')
+        self.assertEqual(len(self.event_buffer), 0)
+
+    def test_flush(self):
+        self.event_buffer.max_events = 2
+        self.elastic_utils.send_event.return_value = "", True
         method = self.method(delivery_tag='delivered')
         callback(self.channel, method, None, self.data)
-        self.log.error.called_with('Failed to create message on Elastic Search')
+
+        flush(self.channel)
+
+        self.channel.basic_ack.assert_called_with(delivery_tag='delivered')
+        self.assertEqual(len(self.event_buffer), 0)
+
+    def _message(self, project_id):
+        return json.dumps({
+            'http_method': 'PUT',
+            'uri': '/v1/AUTH_{}/con/obj'.format(project_id),
+            'headers': {},
+            'timestamp': '2017-02-02T16:53:33.355817'
+        })
+
+    @patch('swift_search_worker.utils.time')
+    def test_over_rate_cap_held_while_others_wait(self, mock_time):
+        mock_time.time.return_value = 0
+        self.scheduler.rate_caps = {'big': 1}
+        self.event_buffer.max_events = 4
+        self.elastic_utils.send_event.return_value = "", True
+
+        for tag in ['big1', 'big2', 'big3', 'big4']:
+            callback(self.channel, self.method(delivery_tag=tag), None,
+                     self._message('big'))
+
+        # One within the cap, one to slide the window, the others held
+        acked = [call[1]['delivery_tag']
+                 for call in self.channel.basic_ack.call_args_list]
+        self.assertEqual(acked, ['big1', 'big2'])
+
+        callback(self.channel, self.method(delivery_tag='small'), None,
+                 self._message('small'))
+        callback(self.channel, self.method(delivery_tag='other'), None,
+                 self._message('other'))
+
+        # Received later, but indexed before the held ones
+        acked = [call[1]['delivery_tag']
+                 for call in self.channel.basic_ack.call_args_list]
+        self.assertEqual(acked, ['big1', 'big2', 'small', 'other', 'big3'])
+        self.assertEqual(len(self.event_buffer), 1)
+
+        flush(self.channel)
+        self.assertEqual(self.channel.basic_ack.call_args[1]['delivery_tag'],
+                         'big4')
+        self.assertEqual(len(self.event_buffer), 0)
+
+    def test_flush_sends_held_events(self):
+        self.scheduler.default_rate_cap = 1
+        self.event_buffer.max_events = 10
+        self.elastic_utils.send_event.return_value = "", True
+
+        for tag in ['first', 'second', 'third']:
+            callback(self.channel, self.method(delivery_tag=tag), None,
+                     self.data)
+
+        # On the timer with the buffer not full nothing else is coming
+        flush(self.channel)
+
+        self.assertEqual(self.channel.basic_ack.call_count, 3)
+        self.assertEqual(len(self.event_buffer), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
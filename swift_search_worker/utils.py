@@ -1,12 +1,25 @@
+import collections
 import json
 import logger
 import pika
+import re
+import sys
+import threading
+import time
 import urllib
+import zlib
 
 from alf.client import Client
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, \
+    wait
+from datetime import datetime
+from functools import lru_cache, partial
 
 log = logger.logger(__name__.split('.')[-1])
 
+# Characters of a project_id that can not be on an ES index name
+INVALID_INDEX_CHARS = re.compile(r'[^a-z0-9_-]')
+
 
 def queue_connection(username, password, host, vhost, port=5672):
     credentials = pika.PlainCredentials(username, password)
@@ -28,11 +41,14 @@ def queue_connection(username, password, host, vhost, port=5672):
     return connection
 
 
-def queue_channel(connection, queue_name):
+def queue_channel(connection, queue_name, prefetch_count=None):
 
     try:
         channel = connection.channel()
         channel.queue_declare(queue=queue_name, durable=True)
+        if prefetch_count:
+            # Limits the unacked messages RabbitMQ delivers to this consumer
+            channel.basic_qos(prefetch_count=prefetch_count)
         log.debug('Queue Channel OK')
     except (pika.exceptions.ConnectionClosed, Exception):
         log.exception('Fail to create channel')
@@ -76,54 +92,598 @@ def get_obj_info(data):
     return info
 
 
+def get_event(data, delivery_tag=None):
+    """
+    Creating the compact event that will be indexed on ES from the
+    message receive from queue, so the message itself can be released
+
+    :param data dict Object metadata receive from queue
+    :param delivery_tag int Queue delivery tag, used to ack the message
+    :returns ObjectEvent or None if the message is invalid
+    """
+    info = get_obj_info(data)
+
+    if not info:
+        return None
+
+    headers = None
+    if 'headers' in info:
+        headers = json.dumps(info['headers'])
+
+    return ObjectEvent(data.get('http_method'),
+                       info['project_id'],
+                       info['container'],
+                       info['object'],
+                       info.get('timestamp', data.get('timestamp', '')),
+                       headers,
+                       delivery_tag)
+
+
+class ObjectEvent(object):
+    """
+    An object metadata event, holding only what is needed to index it
+    The headers are kept already JSON encoded
+    """
+
+    __slots__ = ('method', 'project_id', 'container', 'obj', 'timestamp',
+                 'headers', 'delivery_tag')
+
+    def __init__(self, method, project_id, container, obj, timestamp,
+                 headers=None, delivery_tag=None):
+        self.method = method
+        self.project_id = project_id
+        self.container = container
+        self.obj = obj
+        self.timestamp = timestamp
+        self.headers = headers
+        self.delivery_tag = delivery_tag
+
+    @property
+    def doc_id(self):
+        return '/'.join([self.project_id, self.container, self.obj])
+
+    @property
+    def size(self):
+        # Approximated memory used by the event, in bytes
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, field)) for field in self.__slots__)
+
+    def to_json(self):
+        # Same document as json.dumps(get_obj_info(data))
+        return '{{"project_id": {}, "container": {}, "object": {}, ' \
+            '"headers": {}, "timestamp": {}}}'.format(
+                json.dumps(self.project_id),
+                json.dumps(self.container),
+                json.dumps(self.obj),
+                self.headers,
+                json.dumps(self.timestamp))
+
+
+class EventBuffer(object):
+    """
+    Accounts the events in flight (received, not acked yet), bounded by
+    bytes and by number of events
+    Events that failed to be indexed are held here, to be retried later
+    """
+
+    def __init__(self, max_bytes, max_events):
+        self.max_bytes = max_bytes
+        self.max_events = max_events
+
+        self.failed = collections.deque()
+        self.count = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.size >= self.max_bytes or self.count >= self.max_events
+
+    def add(self, event):
+        self.count += 1
+        self.size += event.size
+
+    def release(self, event):
+        self.count -= 1
+        self.size -= event.size
+
+    def add_failed(self, event):
+        self.failed.append(event)
+
+    def drain_failed(self):
+        failed, self.failed = self.failed, collections.deque()
+
+        return failed
+
+
+class FairScheduler(object):
+    """
+    Queues of the events waiting to be indexed by project_id, kept across
+    flushes and dispatched with deficit round-robin
+
+    Each round a project may dispatch `weight` events (default 1). A
+    project over its rate cap (events per second) keeps its events queued
+    while other projects have events to index, so they go first. When only
+    projects over the cap have events, they are dispatched anyway (up to a
+    limit), so the worker is never idle with events held.
+
+    The events held are the ones in the prefetch window: a project over
+    its cap can only be passed by the events up to QUEUE_PREFETCH messages
+    behind its own on the queue.
+    """
+
+    def __init__(self, weights=None, rate_caps=None, default_rate_cap=0):
+        for project_id, weight in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError('Invalid weight for {}: <{}>'.format(
+                    project_id, weight))
+
+        for project_id, rate_cap in (rate_caps or {}).items():
+            if rate_cap < 0:
+                raise ValueError('Invalid rate cap for {}: <{}>'.format(
+                    project_id, rate_cap))
+
+        if default_rate_cap < 0:
+            raise ValueError('Invalid default rate cap: <{}>'.format(
+                default_rate_cap))
+
+        self.weights = weights or {}
+        self.rate_caps = rate_caps or {}
+        self.default_rate_cap = default_rate_cap
+
+        self.queues = collections.OrderedDict()
+
+        # Token bucket of each capped project: (tokens, last refill)
+        self.buckets = {}
+
+        self.stats = collections.defaultdict(
+            lambda: {'sent': 0, 'failed': 0, 'wait': 0.0, 'waited': 0})
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def add(self, event):
+        self.queues.setdefault(event.project_id,
+                               collections.deque()).append(event)
+
+    def schedule(self, limit=None):
+        """
+        :param limit int Max events of projects over their rate cap to
+            dispatch when no other project has events (None for all)
+        :returns list of events to index now, in order
+        """
+        scheduled = self._round_robin(capped=True)
+
+        # Only projects over their rate cap have events now
+        scheduled.extend(self._round_robin(capped=False, limit=limit))
+
+        return scheduled
+
+    def _round_robin(self, capped, limit=None):
+        scheduled = []
+        deficits = dict.fromkeys(self.queues, 0)
+        blocked = set()
+
+        while len(blocked) < len(self.queues):
+            for project_id in list(self.queues):
+                if limit is not None and len(scheduled) >= limit:
+                    return scheduled
+
+                if project_id in blocked:
+                    continue
+
+                queue = self.queues[project_id]
+                deficits[project_id] += self.weights.get(project_id, 1)
+
+                while queue and deficits[project_id] >= 1:
+                    if limit is not None and len(scheduled) >= limit:
+                        break
+
+                    if capped and not self._take_token(project_id):
+                        blocked.add(project_id)
+                        break
+
+                    scheduled.append(queue.popleft())
+                    deficits[project_id] -= 1
+
+                if not queue:
+                    del self.queues[project_id]
+                    blocked.discard(project_id)
+                else:
+                    # The next call starts from the other projects
+                    self.queues.move_to_end(project_id)
+
+        return scheduled
+
+    def record(self, event, created):
+        stats = self.stats[event.project_id]
+
+        if not created:
+            stats['failed'] += 1
+            return
+
+        stats['sent'] += 1
+
+        # Counts the time spent on the queue too
+        wait = get_event_lag(event.timestamp)
+        if wait is not None:
+            stats['wait'] += wait
+            stats['waited'] += 1
+
+    def metrics(self):
+        """
+        Per project throughput and mean wait (seconds between the event
+        timestamp and its indexing) since the last call, and the events
+        held now
+        """
+        metrics = {}
+        for project_id in set(self.stats) | set(self.queues):
+            stats = self.stats[project_id]
+            waited = stats['waited']
+            metrics[project_id] = {
+                'sent': stats['sent'],
+                'failed': stats['failed'],
+                'held': len(self.queues.get(project_id, ())),
+                'wait': stats['wait'] / waited if waited else 0
+            }
+
+        self.stats.clear()
+
+        return metrics
+
+    def _take_token(self, project_id):
+        rate_cap = self.rate_caps.get(project_id, self.default_rate_cap)
+
+        if not rate_cap:
+            return True
+
+        # Holds one second worth of events, but at least one event, so a
+        # cap under 1 event per second still lets events through
+        capacity = max(rate_cap, 1)
+
+        now = time.time()
+        tokens, last = self.buckets.get(project_id, (capacity, now))
+
+        tokens = min(capacity, tokens + (now - last) * rate_cap)
+
+        if tokens < 1:
+            self.buckets[project_id] = (tokens, now)
+            return False
+
+        self.buckets[project_id] = (tokens - 1, now)
+        return True
+
+
+@lru_cache(maxsize=4096)
+def get_index_url(es_url, project_id, buckets=1):
+    """
+    Resolves the index URL of a project from the Elastic Search URL template
+    The template may have a {project_id} placeholder, for one index per
+    project, or a {bucket} one, for a family of indexes hashed by project
+    The project_id is lowercased and the characters ES does not accept on
+    index names are replaced by '_'
+
+    :param es_url str Elastic Search URL template
+    :param project_id str Project the document belongs to
+    :param buckets int Number of indexes on the {bucket} family
+    :returns str with the index URL
+    """
+    if '{' not in es_url:
+        return es_url
+
+    bucket = zlib.crc32(project_id.encode('utf-8')) % buckets
+
+    index_project_id = INVALID_INDEX_CHARS.sub('_', project_id.lower())
+
+    return es_url.format(project_id=index_project_id, bucket=bucket)
+
+
+def get_event_lag(timestamp):
+    """
+    Seconds elapsed between the event timestamp and now
+
+    :param timestamp str Event timestamp (UTC, isoformat) receive from queue
+    :returns float or None if the timestamp is invalid
+    """
+    try:
+        event_time = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+    except (TypeError, ValueError):
+        return None
+
+    return (datetime.utcnow() - event_time).total_seconds()
+
+
+class ElasticSearchTarget(object):
+    """
+    An Elastic Search cluster that receives the documents,
+    with its own client, metrics and the documents to retry
+    Writes to a target run in order on its own thread, so a slow
+    cluster only delays itself
+    """
+
+    # Writes waiting on a slow target before the new ones fail right away
+    MAX_PENDING = 100
+
+    def __init__(self, es_url, client, max_retries=0, max_retry_bytes=0):
+        self.es_url = es_url
+        self.client = client
+
+        # Events that failed on this target after their message was acked,
+        # by document id, so a newer event replaces the pending one
+        self.retries = collections.OrderedDict()
+        self.retries_size = 0
+        self.max_retries = max_retries
+        self.max_retry_bytes = max_retry_bytes
+        self.retry_future = None
+
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = 0
+
+        self.sent = 0
+        self.errors = 0
+        self.lag = None
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.MAX_PENDING:
+                future = Future()
+                future.set_result(('Too many pending writes', False))
+                return future
+            self.pending += 1
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._write_finished)
+
+        return future
+
+    def _write_finished(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def add_retry(self, event):
+        with self.lock:
+            self._remove_retry(event.doc_id)
+            self.retries[event.doc_id] = event
+            self.retries_size += event.size
+
+            while len(self.retries) > self.max_retries or \
+                    self.retries_size > self.max_retry_bytes:
+                doc_id = next(iter(self.retries))
+                self._remove_retry(doc_id)
+                log.error('{}: retry buffer full, document {} must be '
+                          'backfilled'.format(self.es_url, doc_id))
+
+    def clear_retry(self, event, only_same=False):
+        """
+        :param only_same bool Keeps a newer event of the document
+        """
+        with self.lock:
+            if not only_same or self.retries.get(event.doc_id) is event:
+                self._remove_retry(event.doc_id)
+
+    def _remove_retry(self, doc_id):
+        event = self.retries.pop(doc_id, None)
+        if event:
+            self.retries_size -= event.size
+
+    def record(self, created, timestamp):
+        with self.lock:
+            if created:
+                self.sent += 1
+                self.lag = get_event_lag(timestamp)
+            else:
+                self.errors += 1
+
+        if created:
+            log.debug('{}: document indexed, lag {}s'.format(self.es_url,
+                                                             self.lag))
+        else:
+            log.error('{}: failed to index document ({} errors)'.format(
+                self.es_url, self.errors))
+
+    def metrics(self):
+        with self.lock:
+            return {'sent': self.sent, 'errors': self.errors,
+                    'lag': self.lag, 'retries': len(self.retries)}
+
+
 class ElasticSearchUtils(object):
 
-    def __init__(self, token_endpoint, client_id, client_secret, es_url):
+    ACK_POLICIES = ('all', 'primary', 'quorum')
+
+    def __init__(self, token_endpoint, client_id, client_secret, es_url,
+                 replica_urls=None, ack_policy='all', index_buckets=1,
+                 routing=False, max_retries=10000,
+                 max_retry_bytes=8 * 1024 * 1024, timeout=10):
+        """
+        :param es_url str Primary Elastic Search URL (see get_index_url)
+        :param replica_urls list Extra Elastic Search URLs that also receive
+            every document (e.g. during cluster migrations)
+        :param ack_policy str When a message is considered indexed:
+            all targets, primary only or a quorum of targets
+        :param index_buckets int Number of indexes on a {bucket} family
+        :param routing bool Send the project_id as the ES routing value
+        :param max_retries int Max documents each target keeps to retry
+            when it fails but the message is acked (see retry_failed)
+        :param max_retry_bytes int Max bytes of these documents per target
+        :param timeout float Seconds to wait for each Elastic Search request
+        """
+        if ack_policy not in self.ACK_POLICIES:
+            raise ValueError('Invalid ack policy: <{}>'.format(ack_policy))
+
+        if index_buckets < 1:
+            raise ValueError('Invalid index buckets: <{}>'.format(
+                index_buckets))
+
+        for url in [es_url] + list(replica_urls or []):
+            # ES index names can not start with _, - or +
+            if url and '/{project_id}' in url:
+                raise ValueError('Index name needs a prefix before '
+                                 '{{project_id}}: <{}>'.format(url))
+
         self.token_endpoint = token_endpoint
         self.client_id = client_id
         self.client_secret = client_secret
         self.es_url = es_url
+        self.ack_policy = ack_policy
+        self.index_buckets = index_buckets
+        self.routing = routing
+        self.timeout = timeout
 
-        self.client = self.get_alf_client()
+        # The primary target is always the first one
+        self.targets = [ElasticSearchTarget(url, self.get_alf_client(),
+                                            max_retries, max_retry_bytes)
+                        for url in [es_url] + list(replica_urls or [])]
+        self.client = self.targets[0].client
 
     def send_to_elastic(self, data):
-        # ES document _id will be account_id/container/object (url_encoded)
+        event = get_event(data)
 
-        obj_info = get_obj_info(data)
-
-        if not obj_info:
+        if not event:
             return 'Invalid object info', False
 
-        obj_url = self._get_es_obj_url(obj_info)
+        return self.send_event(event)
+
+    def send_event(self, event):
+        # ES document _id will be account_id/container/object (url_encoded)
+
+        if event.method not in ('POST', 'PUT', 'DELETE'):
+            return "Invalid http method", False
 
-        if data['http_method'] == 'POST':
-            log.info("POST to {} with data {}".format(obj_url, obj_info))
+        # The document is serialized once and shared by all targets
+        body = None
+        if event.method != 'DELETE':
+            body = event.to_json()
+
+        if len(self.targets) == 1:
+            target = self.targets[0]
+            msg, created = self._send_to_target(target, event, body)
+            target.record(created, event.timestamp)
+
+            return msg, created
+
+        futures = [target.submit(self._send_to_target, target, event, body)
+                   for target in self.targets]
+
+        msg, acked = self._wait_ack(futures)
+
+        for target, future in zip(self.targets, futures):
+            # Runs right away for the writes already done, or later, on the
+            # target thread, for the ones the ack policy did not wait for
+            future.add_done_callback(
+                partial(self._write_done, target, event, acked))
+
+        return msg, acked
+
+    def _write_done(self, target, event, acked, future):
+        _, created = future.result()
+        target.record(created, event.timestamp)
+
+        if created:
+            # Newer than the pending retry of the document, if any
+            target.clear_retry(event)
+        elif acked:
+            # The message is gone from the queue, so this target
+            # has to retry it by itself
+            target.add_retry(event)
+
+    def retry_failed(self):
+        """
+        Writes again, on the thread of each target, the documents it failed
+        to index after the message was acked. Stops at the first failure
+
+        :returns list of futures of the retries started
+        """
+        futures = []
+        for target in self.targets:
+            running = target.retry_future and not target.retry_future.done()
+            if target.retries and not running:
+                target.retry_future = target.executor.submit(
+                    self._retry_target, target)
+                futures.append(target.retry_future)
+
+        return futures
+
+    def close(self):
+        """
+        Retries once more, after the writes in flight, the documents pending
+        on each target and logs the ones still missing, to be backfilled
+        Waits up to the request timeout
+        """
+        futures = [target.executor.submit(self._retry_target, target)
+                   for target in self.targets]
+        wait(futures, timeout=self.timeout)
+
+        for target in self.targets:
+            with target.lock:
+                doc_ids = list(target.retries)
+                pending = target.pending
+
+            for doc_id in doc_ids:
+                log.error('{}: document {} must be backfilled'.format(
+                    target.es_url, doc_id))
+
+            if pending:
+                log.error('{}: {} writes still in flight, the documents '
+                          'written since the last ack must be '
+                          'checked'.format(target.es_url, pending))
+
+            target.executor.shutdown(wait=False)
+
+    def _retry_target(self, target):
+        while True:
+            with target.lock:
+                if not target.retries:
+                    return
+                doc_id, event = next(iter(target.retries.items()))
+
+            body = None
+            if event.method != 'DELETE':
+                body = event.to_json()
+
+            _, created = self._send_to_target(target, event, body)
+            target.record(created, event.timestamp)
+
+            if not created:
+                return
+
+            target.clear_retry(event, only_same=True)
+
+    def _send_to_target(self, target, event, body):
+        obj_url = self._get_es_obj_url(event, target.es_url)
+
+        if event.method == 'POST':
+            log.info("POST to {} with data {}".format(obj_url, body))
             try:
-                res = self.client.post(obj_url, data=json.dumps(obj_info),
-                                   headers={'Content-Type':
-                                            'application/json'})
+                res = target.client.post(obj_url, data=body,
+                                         headers={'Content-Type':
+                                                  'application/json'},
+                                         timeout=self.timeout)
             except Exception as e:
                 log.exception("Unable to POST data to ES")
                 return "Unable to POST data to ES", False
 
-        elif data['http_method'] == 'DELETE':
+        elif event.method == 'DELETE':
             log.info("DELETE to {}".format(obj_url))
             try:
-                res = self.client.delete(obj_url)
+                res = target.client.delete(obj_url, timeout=self.timeout)
             except Exception as e:
                 log.exception("Unable to DELETE data on ES")
-                return "Unable to DELETE data on ES".format(e), False
+                return "Unable to DELETE data on ES", False
 
-        elif data['http_method'] == 'PUT':
-            log.info("PUT to {} with data {}".format(obj_url, obj_info))
+        else:
+            log.info("PUT to {} with data {}".format(obj_url, body))
             try:
-                res = self.client.put(obj_url, data=json.dumps(obj_info),
-                                      headers={'Content-Type': 'application/json'})
+                res = target.client.put(obj_url, data=body,
+                                        headers={'Content-Type':
+                                                 'application/json'},
+                                        timeout=self.timeout)
             except Exception as e:
                 log.exception("Unable to PUT data to ES")
-                return "Unable to PUT data to ES".format(e), False
-        else:
-            return "Invalid http method", False
+                return "Unable to PUT data to ES", False
 
         # True or False to control the consumption of queue messages
         # Will only consume the message if the document was created
@@ -131,18 +691,67 @@ class ElasticSearchUtils(object):
         # On the case of a 404 on a delete, the message will be
         # consumed anyway, since the document doens't exist on ES
         if res.status_code in [200, 201] or \
-           (data['http_method'] == 'DELETE' and res.status_code == 404):
+           (event.method == 'DELETE' and res.status_code == 404):
             return "", True
         else:
             return "Object not created", False
 
-    def _get_es_obj_url(self, obj_info):
+    def _wait_ack(self, futures):
+        """
+        Waits only for the writes the ack policy needs
+
+        :param futures list of futures of (msg, created), primary first
+        :returns tuple (msg, created) for the whole write
+        """
+        if self.ack_policy == 'primary':
+            return futures[0].result()
+
+        needed = len(futures)
+        if self.ack_policy == 'quorum':
+            needed = len(futures) // 2 + 1
+
+        created = 0
+        failures = []
+        for future in as_completed(futures):
+            msg, status = future.result()
+
+            if status:
+                created += 1
+                if created == needed:
+                    return "", True
+            else:
+                failures.append(msg)
+                if len(failures) > len(futures) - needed:
+                    return failures[0], False
+
+    def metrics(self):
+        return dict((target.es_url, target.metrics())
+                    for target in self.targets)
+
+    def _get_es_obj_url(self, event, es_url=None):
+
+        index_url = get_index_url(es_url or self.es_url, event.project_id,
+                                  self.index_buckets)
+
+        return index_url + '/' + urllib.parse.quote_plus(event.doc_id) + \
+            self._get_routing_param(event.project_id)
+
+    def get_search_url(self, project_id):
+        """
+        Search URL scoped to the index and shard of a single project
+
+        :param project_id str
+        :returns str with the _search URL on the primary Elastic Search
+        """
+        index_url = get_index_url(self.es_url, project_id, self.index_buckets)
+
+        return index_url + '/_search' + self._get_routing_param(project_id)
 
-        obj_id = '/'.join([obj_info.get('project_id'),
-                           obj_info.get('container'),
-                           obj_info.get('object')])
+    def _get_routing_param(self, project_id):
+        if not self.routing:
+            return ''
 
-        return self.es_url + '/' + urllib.parse.quote_plus(obj_id)
+        return '?routing=' + urllib.parse.quote_plus(project_id)
 
     def get_alf_client(self):
         # alf is an OAuth 2 Client
@@ -5,29 +5,107 @@ import json
 import logger
 import sys
 
-from utils import ElasticSearchUtils, queue_connection, queue_channel
+from utils import ElasticSearchUtils, EventBuffer, FairScheduler, \
+    get_event, queue_connection, queue_channel
 
 log = logger.logger(__name__.split('.')[-1])
 
 elastic_utils = ElasticSearchUtils(config.TOKEN_ENDPOINT,
                                    config.CLIENT_ID,
                                    config.CLIENT_SECRET,
-                                   config.ES_URL)
+                                   config.ES_URL,
+                                   config.ES_REPLICA_URLS,
+                                   config.ES_ACK_POLICY,
+                                   config.ES_INDEX_BUCKETS,
+                                   config.ES_ROUTING,
+                                   config.ES_MAX_RETRIES,
+                                   config.ES_MAX_RETRY_BYTES,
+                                   config.ES_TIMEOUT)
+
+event_buffer = EventBuffer(config.BUFFER_MAX_BYTES, config.QUEUE_PREFETCH)
+
+scheduler = FairScheduler(config.TENANT_WEIGHTS,
+                          config.TENANT_RATE_CAPS,
+                          config.TENANT_DEFAULT_RATE_CAP)
 
 
 def callback(ch, method, properties, body):
-    global elastic_utils
+    global event_buffer, scheduler
 
     try:
-        msg, created = elastic_utils.send_to_elastic(json.loads(body))
+        event = get_event(json.loads(body), method.delivery_tag)
+    except ValueError:
+        event = None
+
+    if not event:
+        # Invalid messages would hold a prefetch slot forever
+        log.error('Invalid message')
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        return
+
+    event_buffer.add(event)
+    scheduler.add(event)
+
+    # While the buffer is flushed the consumer is blocked on this
+    # callback, so no more messages are pulled from RabbitMQ
+    # The events of projects over their rate cap held in the buffer
+    # only go one at a time, so the window slides over the next messages
+    if event_buffer.full:
+        flush(ch, limit=1)
+
+
+def flush(ch, retry=False, limit=None):
+    """
+    :param retry bool Also retries the events that failed
+    :param limit int Max events of projects over their rate cap to index
+        (see FairScheduler.schedule)
+    """
+    global elastic_utils, event_buffer, scheduler
+
+    # Failed events are only retried by the timer, so an unavailable ES
+    # is not hit again on every message
+    if retry:
+        for event in event_buffer.drain_failed():
+            scheduler.add(event)
+
+    for event in scheduler.schedule(limit):
+        msg, created = elastic_utils.send_event(event)
+        scheduler.record(event, created)
         if created:
             # If the message was sent to ES, ack
-            # Otherwise, keep it on queue
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            # Otherwise, keep it to retry on the next flush_timeout
+            ch.basic_ack(delivery_tag=event.delivery_tag)
+            event_buffer.release(event)
         else:
             log.error('Failed to create message on Elastic Search')
-    except ValueError:
-        log.error('Invalid message')
+            event_buffer.add_failed(event)
+
+
+def flush_timeout(connection, channel):
+    global elastic_utils, event_buffer
+
+    # A full buffer means RabbitMQ has more to deliver, so the window
+    # only slides. Otherwise nothing else is coming and every event goes
+    flush(channel, retry=True, limit=1 if event_buffer.full else None)
+    elastic_utils.retry_failed()
+
+    connection.add_timeout(config.BUFFER_FLUSH_INTERVAL,
+                           lambda: flush_timeout(connection, channel))
+
+
+def report_metrics(connection):
+    global elastic_utils, scheduler
+
+    for es_url, metrics in elastic_utils.metrics().items():
+        log.info('{}: sent {sent}, errors {errors}, lag {lag}s, '
+                 'retries {retries}'.format(es_url, **metrics))
+
+    for project_id, metrics in scheduler.metrics().items():
+        log.info('{}: sent {sent}, failed {failed}, held {held}, '
+                 'wait {wait:.3f}s'.format(project_id, **metrics))
+
+    connection.add_timeout(config.METRICS_INTERVAL,
+                           lambda: report_metrics(connection))
 
 
 if __name__ == '__main__':
@@ -37,10 +115,17 @@ if __name__ == '__main__':
                                   host=config.QUEUE_URL,
                                   vhost=config.QUEUE_VHOST) or sys.exit(1)
 
-    channel = queue_channel(connection, config.QUEUE_NAME) or sys.exit(1)
+    channel = queue_channel(connection, config.QUEUE_NAME,
+                            config.QUEUE_PREFETCH) or sys.exit(1)
 
     channel.basic_consume(callback, config.QUEUE_NAME)
 
+    connection.add_timeout(config.BUFFER_FLUSH_INTERVAL,
+                           lambda: flush_timeout(connection, channel))
+
+    connection.add_timeout(config.METRICS_INTERVAL,
+                           lambda: report_metrics(connection))
+
     try:
         log.info('Starting consumer')
         channel.start_consuming()
@@ -48,5 +133,11 @@ if __name__ == '__main__':
         log.info('Stoping consumer')
         channel.stop_consuming()
 
+    log.debug('Flushing buffered events')
+    flush(channel)
+
+    log.debug('Retrying the documents pending on Elastic Search')
+    elastic_utils.close()
+
     log.debug('Closing queue connection')
     connection.close()